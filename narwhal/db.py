@@ -87,12 +87,7 @@ class DBObject:
 				idict[name] = value
 
 	def Serialize(self, force_update=False):
-		sql = SQL.Get()
-		idict = object.__getattribute__(self, "__dict__")
-		if "dbid" in idict.keys():
-			sql.Update(self, force_update)
-		else:
-			sql.Add(self)
+		SQL.Get().Upsert(self, force_update)
 
 
 class Mutable(DBObject):
@@ -242,44 +242,34 @@ class List(Generic[T]):
 			)
 			self.initialized = True
 
-	# NOTE: Oddly, updating with sql.UpdateList (executemany) 
-	# is slower than updating with sql.Update (execute).
-
-	def __add_to_db__(self):
+	def __items_to_db__(self):
+		"""
+		Returns the child items whose rows need to be written to
+		keep this list in the DB, without writing them, so that
+		the caller can batch them with other lists.
+		"""
 		if not self.from_db:
 			self.__validate_parent__()
 
 			id_key = self.id_key
-			sql = SQL.Get()
-
 			for item in self.items:
 				item.__dict__[id_key] = self.parent.dbid
-				sql.Update(item, commit=False)
-			#sql.UpdateList(self.items, commit=False)
 			
 			self.from_db = True
 			self.initialized = True
-		else:
-			self.__update_to_db__()
-
-	def __update_to_db__(self):
-		if self.initialized:
+			return list(self.items)
+		elif self.initialized:
 			self.__validate_parent__()
 
 			id_key = self.id_key
-			sql = SQL.Get()
 
-			# Update any items that were removed from this list
-			for item in self.former_items:
-				sql.Update(item, commit=False)
-			#sql.UpdateList(self.former_items, commit=False)
+			# Write any items that were removed from this list
+			items = self.former_items
 			self.former_items = []
 			
-			# Update all items that are now in the list
+			# And all items that are now in the list
 			# TODO: could optimize by what's actually been touched
 			for item in self.items:
 				item.__dict__[id_key] = self.parent.dbid
-				sql.Update(item, commit=False)
-			#sql.UpdateList(self.items, commit=False)
-
-			self.from_db = True
\ No newline at end of file
+			return items + self.items
+		return []
\ No newline at end of file
@@ -1,5 +1,7 @@
 import sys
 import sqlite3
+from array import array
+from random import sample
 from datetime import datetime, date
 from typing import get_args, get_origin
 
@@ -60,16 +62,8 @@ class Query:
 		)
 
 	def ChainExprs(exprs, chain_str=", "):
-		query_str = ""
-		val_tup = ()
-		expr_range = len(exprs) - 1
-		for i in range(expr_range):
-			expr = exprs[i]
-			query_str += f"({expr[0]}){chain_str}"
-			val_tup += expr[1]
-		expr = exprs[expr_range]
-		query_str += f"({expr[0]})"
-		val_tup += expr[1]
+		query_str = chain_str.join( f"({expr[0]})" for expr in exprs )
+		val_tup = tuple( val for expr in exprs for val in expr[1] )
 		return ( query_str, val_tup )
 
 	def And(*exprs):
@@ -83,7 +77,7 @@ class Query:
 	OrderDescending = lambda v : f"{v} desc"
 
 	def OrderChain(*exprs):
-		return Query.ChainExprs(exprs)
+		return ", ".join(exprs)
 
 
 class SQL:
@@ -109,6 +103,29 @@ class SQL:
 		"timestamp"	: datetime(1000, 1, 1)
 	}
 
+	# Largest number of rows RandomEntries picks by dbid lookup,
+	# rather than by sorting the table
+	RANDOM_LOOKUP_MAX = 1000
+
+	# Most bound variables one statement may use on older SQLite builds
+	MAX_VARIABLES = 999
+
+	# array typecodes for types loaded as whole columns
+	TYPE_ARRAY = {
+		"integer"	: "q",
+		"real"		: "d"
+	}
+
+	# Rough in-memory size of a value of each type, in bytes.
+	# Types missing here use the size of their default value.
+	TYPE_SIZE = {
+		"text" 		: 64,
+		"integer"	: 28,
+		"real"		: 24,
+		"date"		: 32,
+		"timestamp"	: 48
+	}
+
 	def RegisterTypeConversion(data_class:type, adapter, converter, default):
 		"""
 		Register your custom data type for storage in the DB.
@@ -162,28 +179,48 @@ class SQL:
 		if list_order_column not in sql_columns:
 			sql_columns.append(list_order_column)
 
+		# index the children by parent, in list order
+		if not hasattr(child_class, "__sql_list_indexes__"):
+			child_class.__sql_list_indexes__ = []
+		list_index = ( id, order )
+		if list_index not in child_class.__sql_list_indexes__:
+			child_class.__sql_list_indexes__.append(list_index)
+
 	def Get():
 		return SQL.DEFAULT_DB
 
-	def __init__(self, db_path:str):
+	def __init__(self, db_path:str, journal_mode="wal", synchronous="normal"):
 		self.connection = sqlite3.connect(
 			db_path,
-			detect_types=sqlite3.PARSE_DECLTYPES
+			detect_types=sqlite3.PARSE_DECLTYPES,
+			cached_statements=256
 		)
 		self.connection.row_factory = sqlite3.Row
+		# WAL + normal sync means a commit doesn't have to
+		# fsync the whole DB file
+		self.connection.execute(f"pragma journal_mode={journal_mode}")
+		self.connection.execute(f"pragma synchronous={synchronous}")
+		self.tables = []
 		self.cache = {}
+		self.column_cache = {}
+		# One cursor shared by all reads. Its rows are plain tuples,
+		# which are quicker to read by position than sqlite3.Row.
+		# Every read must run to completion (see FetchOne), or the
+		# pending statement keeps a read transaction open, and must
+		# fetch its rows before building objects from them, since
+		# constructors may run reads of their own
+		self.cursor = self.connection.cursor()
+		self.cursor.row_factory = None
 		SQL.DEFAULT_DB = self
 
 	def CacheSize(self):
 		"""
-		Return the size of the DB cache in memory.
+		Return the approximate size of the DB cache in memory,
+		estimated from the number of cached rows of each table.
 		"""
 		sz = 0
-		for key, item in self.cache.items():
-			sz += sys.getsizeof(key)
-			for k, i in item.items():
-				sz += sys.getsizeof(k)
-				sz += sys.getsizeof(i)
+		for data_class in self.tables:
+			sz += len(self.cache[data_class.__name__]) * data_class.__approx_row_bytes__
 		return sz
 
 	def MakeColumns(data_class: type):
@@ -194,19 +231,25 @@ class SQL:
 
 		Lists may add entries to those columns to add 
 		1:M relations.
+
+		The result is cached on the class, so annotations
+		are only inspected once.
 		"""
+		if "__sql_columns_cached__" in data_class.__dict__:
+			return list(data_class.__sql_columns_cached__)
+
 		sql_columns = []
 		annotations = data_class.__annotations__
 		for var_name, var_type in annotations.items():
 			classname = ""
-			if hasattr(var_type, "__name__"):
-				classname = var_type.__name__
-			else:
+			if get_origin(var_type) != None:
 				# Reference or List
 				var_args = get_args(var_type)[0]
 				var_type = get_origin(var_type)
+			else:
+				classname = var_type.__name__
 
-			if classname in SQL.TYPE_TABLE.keys():
+			if classname in SQL.TYPE_TABLE:
 				sql_columns.append(
 					( var_name, SQL.TYPE_TABLE[classname] )
 				)
@@ -218,13 +261,130 @@ class SQL:
 				SQL.RegisterList(data_class, var_args, var_name)
 			else:
 				print(f"WARNING: {var_name} in {data_class.__name__} not a recognized datatype!")
+		data_class.__sql_columns_cached__ = tuple(sql_columns)
 		return sql_columns
 
+	def RowSize(data_class: type) -> int:
+		"""
+		Estimates the in-memory size of one row of the class
+		from its column types.
+		"""
+		# dbid
+		sz = SQL.TYPE_SIZE["integer"]
+		for column in data_class.__sql_columns__:
+			column_type = column[1]
+			if column_type in SQL.TYPE_SIZE:
+				sz += SQL.TYPE_SIZE[column_type]
+			else:
+				sz += sys.getsizeof(SQL.TYPE_DEFAULT[column_type])
+		return sz
+
+	def MakeFields(data_class: type):
+		"""
+		Resolves each column into a ( name, type, default ) tuple,
+		so that adding rows doesn't need to look up defaults.
+
+		Also flags, per column, whether it is declared with a type
+		that converts itself via __sql_adapter__ (e.g. Reference),
+		so that values of other columns are never checked for one.
+		"""
+		data_class.__sql_fields__ = tuple(
+			( column[0], column[1], SQL.TYPE_DEFAULT[column[1]] )
+			for column in data_class.__sql_columns__
+		)
+
+		data_class.__sql_needs_adapter__ = tuple(
+			SQL.ColumnAdapts(data_class, column[0])
+			for column in data_class.__sql_columns__
+		)
+
+	def ColumnAdapts(data_class: type, var_name: str) -> bool:
+		"""
+		Whether the column is declared with a type that converts
+		itself via __sql_adapter__ (e.g. Reference).
+		"""
+		# list columns have no annotation
+		var_type = data_class.__annotations__.get(var_name)
+		if get_origin(var_type) != None:
+			var_type = get_origin(var_type)
+		return hasattr(var_type, "__sql_adapter__")
+
+	def AdaptValue(value, default):
+		"""
+		Converts the value of a column that needs an adapter. Only
+		a missing value, i.e. the default, is passed through as is.
+		"""
+		if value is default:
+			return value
+		return value.__sql_adapter__()
+
+	def MakeRowFunction(data_class: type):
+		"""
+		Generates a function specialized to the class that builds
+		the row inserted into the DB for an item, with every column
+		unrolled, and stores it in the data class as __fast_row__.
+
+		For columns a, b where b is a Reference, it looks like:
+
+		def _row_tuple(item):
+			get = item.__dict__.get
+			return ( item.dbid, get('a', _d0), _adapt(get('b', _d1), _d1), )
+		"""
+		namespace = { "_adapt" : SQL.AdaptValue }
+		values = [ "item.dbid" ]
+		fields = zip(data_class.__sql_fields__, data_class.__sql_needs_adapter__)
+		for i, ( field, needs_adapter ) in enumerate(fields):
+			var_name = field[0]
+			namespace[f"_d{i}"] = field[2]
+			value = f"get({var_name!r}, _d{i})"
+			if needs_adapter:
+				value = f"_adapt({value}, _d{i})"
+			values.append(value)
+
+		src = (
+			"def _row_tuple(item):\n"
+			"\tget = item.__dict__.get\n"
+			f"\treturn ( {', '.join(values)}, )\n"
+		)
+		code = compile(src, f"<narwhal row {data_class.__name__}>", "exec")
+		exec(code, namespace)
+		data_class.__fast_row__ = staticmethod(namespace["_row_tuple"])
+
+	def MakeCommands(data_class: type):
+		"""
+		Builds the select, insert, update and upsert commands for
+		the class once, and stores them in the data class itself, so
+		that sqlite can reuse its prepared statements.
+		"""
+		sql_columns = data_class.__sql_columns__
+		table_name = data_class.__tablename__
+
+		# name the columns, so rows come back in the order
+		# of __sql_columns__ and can be read by position
+		names = ", ".join( ["dbid"] + [ column[0] for column in sql_columns ] )
+		data_class.__sql_select__ = f"select {names} from {table_name}"
+
+		values = ", ".join( ["?"] * (len(sql_columns) + 1) )
+		data_class.__sql_insert__ = f"insert into {table_name} values ({values})"
+
+		# leaves the dbid for sqlite to assign
+		names_noid = ", ".join( column[0] for column in sql_columns )
+		values_noid = ", ".join( ["?"] * len(sql_columns) )
+		data_class.__sql_insert_noid__ = f"insert into {table_name} ({names_noid}) values ({values_noid})"
+
+		assignments = ", ".join( f"{column[0]} = ?" for column in sql_columns )
+		data_class.__sql_update__ = f"update {table_name} set {assignments} where dbid = ?"
+
+		excluded = ", ".join( f"{column[0]} = excluded.{column[0]}" for column in sql_columns )
+		data_class.__sql_upsert__ = (
+			f"insert into {table_name} ({names}) values ({values}) "
+			f"on conflict(dbid) do update set {excluded}"
+		)
 
 	def RegisterTables(self, data_classes:list):
 		"""
 		Registers the classes that will be used as tables
-		in the DB. Should be run only once.
+		in the DB. Should be run only once per connection.
 		"""
 		self.tables = data_classes
 		for data_class in data_classes:
@@ -233,15 +393,26 @@ class SQL:
 			# initialize cache
 			self.cache[dc_name] = {}
 
-			# initialize column names
+			# initialize column names, unless another connection
+			# has already registered the class
 			if not hasattr(data_class, "__sql_columns__"):
 				data_class.__sql_columns__ = []
-			data_class.__sql_columns__ += SQL.MakeColumns(data_class)
+			if "__sql_columns_cached__" not in data_class.__dict__:
+				data_class.__sql_columns__ += SQL.MakeColumns(data_class)
 
 			# initialize table name
-			if "__tablename__" not in data_class.__dict__.keys():
+			if "__tablename__" not in data_class.__dict__:
 				data_class.__tablename__ = f"{dc_name.lower()}_table"
-			
+
+		# resolve fields, generate row functions, build commands
+		# and estimate row sizes only once every class has been
+		# seen, since lists add columns to their child classes
+		for data_class in data_classes:
+			SQL.MakeFields(data_class)
+			SQL.MakeRowFunction(data_class)
+			SQL.MakeCommands(data_class)
+			data_class.__approx_row_bytes__ = SQL.RowSize(data_class)
+
 	# TODO: don't create the tables if not needed
 	def CreateTables(self):
 		for data_class in self.tables:
@@ -260,7 +431,7 @@ class SQL:
 		# tuples of ( column_name, column_type )
 		column_name = lambda c : c[0]
 		column_type = lambda c : c[1]
-		cmd = f"create table {table_name} ( dbid integer primary key, "
+		cmd = f"create table {table_name} ( dbid integer primary key autoincrement, "
 		col_range = len(sql_columns) - 1
 		for i in range( col_range ):
 			column = sql_columns[i]
@@ -270,6 +441,18 @@ class SQL:
 
 		# execute it
 		self.connection.execute(cmd)
+
+		# indexes are either a column name, or a tuple
+		# of column names for a composite index
+		indexes = list( getattr(data_class, "__sql_indexes__", []) )
+		indexes += getattr(data_class, "__sql_list_indexes__", [])
+		for index in indexes:
+			if type(index) == str:
+				index = ( index, )
+			index_name = f"idx_{table_name}_{'_'.join(index)}"
+			self.connection.execute(
+				f"create index if not exists {index_name} on {table_name} ({', '.join(index)})"
+			)
 		self.connection.commit()
 
 	def Clear(self, data_class:type):
@@ -282,19 +465,58 @@ class SQL:
 		self.connection.commit()
 		# Clear our cache
 		self.cache[data_class.__name__] = {}
+		self.column_cache.pop(data_class.__name__, None)
 
 	def TableLength(self, data_class:type) -> int:
 		"""
 		Returns the number of rows in a table.
 		"""
-		# TODO: sooo sloow - any way to speed this up???
 		table_name = data_class.__tablename__
-		cmd = f"select * from {table_name}"
-		cursor = self.connection.cursor()
-		cursor.execute(cmd)
-		size = len(cursor.fetchall())
-		cursor.close()
-		return size
+		cmd = f"select count(*) from {table_name}"
+		return SQL.FetchOne(self.cursor.execute(cmd))[0]
+
+	def Begin(self):
+		"""
+		Explicitly open a transaction, unless one is already open.
+		Everything up to the next commit is written in one go.
+
+		The transaction takes the write lock immediately, so no other
+		connection can write between our reads and writes in it.
+		"""
+		if not self.connection.in_transaction:
+			self.connection.execute("begin immediate")
+
+	def NextDbid(self, data_class:type) -> int:
+		"""
+		Internal method returning the dbid for the next new row of a
+		table: one past both its largest dbid and the largest dbid
+		sqlite has ever handed out for it, so that ids aren't reused.
+		Like the dbids sqlite assigns in Add, the first one is 1.
+
+		Only call this within a transaction opened by Begin.
+		"""
+		table_name = data_class.__tablename__
+		max_dbid = SQL.FetchOne(self.cursor.execute(
+			f"select max(dbid) from {table_name}"
+		))[0]
+		# sqlite_sequence only exists once some table is autoincrement,
+		# which tables created by older versions of narwhal are not
+		seq = None
+		has_sequence = SQL.FetchOne(self.cursor.execute(
+			"select 1 from sqlite_master where type = 'table' "
+			"and name = 'sqlite_sequence'"
+		))
+		if has_sequence != None:
+			seq = SQL.FetchOne(self.cursor.execute(
+				"select seq from sqlite_sequence where name = ?",
+				(table_name,)
+			))
+		next_dbid = 1
+		if max_dbid != None:
+			next_dbid = max_dbid + 1
+		if seq != None:
+			next_dbid = max(next_dbid, seq[0] + 1)
+		return next_dbid
 
 	def Commit(self):
 		"""
@@ -303,6 +525,14 @@ class SQL:
 		"""
 		self.connection.commit()
 
+	def _update_tuple(self, item, data_class:type) -> tuple:
+		"""
+		Internal method to build the arguments of __sql_update__
+		for an item: the column values, then its dbid.
+		"""
+		row = data_class.__fast_row__(item)
+		return row[1:] + row[:1]
+
 	def Add(self, item, commit=True):
 		"""
 		Adds the item as a row to its corresponding table.
@@ -311,50 +541,31 @@ class SQL:
 		immediately committed to the DB.
 		"""
 		data_class = item.__class__
+		dc_name = data_class.__name__
 
-		table_name = data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
 		idict = item.__dict__
-		valid_columns = idict.keys()
 
-		if "dbid" in valid_columns:
+		if "dbid" in idict:
 			if item.dbid != -1:
 				self.Update(item, commit=commit)
 				return
-		# dbid
-		item.dbid = self.TableLength(data_class)
+		self.Begin()
+		self.column_cache.pop(dc_name, None)
+
+		# save it to the table, letting sqlite assign the dbid
+		item.dbid = -1
+		row = data_class.__fast_row__(item)
+		cursor = self.connection.execute(
+			data_class.__sql_insert_noid__,
+			row[1:]
+		)
+		item.dbid = cursor.lastrowid
 
 		# cache the item
-		self.cache[data_class.__name__][item.dbid] = item
-		
-		attr_list = []
-		attr_list.append(item.dbid)
-		# all other attributes
-		for column in sql_columns:
-			var_name = column[0]
-			var_type = column[1]
-			# save it if there's a value;
-			# otherwise set it to a default value
-			if var_name in idict.keys():
-				var_value = idict[ var_name ]
-				if hasattr(var_value, "__sql_adapter__"):
-					var_value = var_value.__sql_adapter__()
-				attr_list.append( var_value )
-			else:
-				attr_list.append( 
-					SQL.TYPE_DEFAULT[var_type]
-				)
-	
-		# save them to the table
-		cmd = f"insert into {table_name} values (?, "
-		for i in range ( len(sql_columns) - 1 ):
-			cmd = cmd + "?, "
-		cmd = cmd + "?)"
-		self.connection.execute(cmd, attr_list)
+		self.cache[dc_name][item.dbid] = item
 
 		# finally, add lists
-		for list in item.__get_lists__():
-			list.__add_to_db__()
+		self.WriteLists( (item,) )
 
 		if commit:
 			self.connection.commit()
@@ -371,64 +582,109 @@ class SQL:
 			return
 		data_class 	= i_list[0].__class__
 		dc_name = data_class.__name__
-		table_name 	= data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
 
 		item_list = []
 
+		self.Begin()
+		self.column_cache.pop(dc_name, None)
 		for item in i_list:
 			if hasattr(item, "dbid"):
 				if item.dbid != -1:
-					self.Update(item, commit=commit)
+					self.Update(item, commit=False)
 					continue
 			item_list.append(item)
 
 		# create the new table entries
 		#attr_types = data_class.__annotations__
+		fast_row = data_class.__fast_row__
+		rows = []
+		for item in item_list:
+			item.dbid = -1
+			rows.append( fast_row(item) )
+
+		# executemany can't report the dbids sqlite assigns, so hand
+		# them out here. Building the rows may have added other rows
+		# (e.g. through a Reference), so only look the next one up
+		# now. Begin holds the write lock, so no one else can take it.
+		next_dbid = self.NextDbid(data_class)
 		new_entries = []
-		for i in range( len(item_list) ):
-			item = item_list[i]
+		for item, row in zip(item_list, rows):
 			# dbid
-			item.dbid = i
+			item.dbid = next_dbid
+			next_dbid += 1
 
 			# cache the item
 			self.cache[dc_name][item.dbid] = item
 
-			attr_list = []
-			attr_list.append(item.dbid)
-			# all other attributes
-			idict = item.__dict__
-			for column in sql_columns:
-				var_name = column[0]
-				var_type = column[1]
-				# save it if there's a value;
-				# otherwise set it to a default value
-				if var_name in idict.keys():
-					var_value = idict[ var_name ]
-					if hasattr(var_value, "__sql_adapter__"):
-						var_value = var_value.__sql_adapter__()
-					attr_list.append( var_value )
-				else:
-					attr_list.append( 
-						SQL.TYPE_DEFAULT[var_type]
-					)
-			new_entries.append( tuple(attr_list) )
+			new_entries.append( (item.dbid,) + row[1:] )
 		
 		# save them to the table
-		cmd = f"insert into {table_name} values (?, "
-		for i in range ( len(sql_columns) - 1 ):
-			cmd = cmd + "?, "
-		cmd = cmd + "?)"
-		self.connection.executemany(cmd, new_entries)
+		self.connection.executemany(data_class.__sql_insert__, new_entries)
 
 		# Finally, add lists for each object
-		for item in item_list:
-			for list in item.__get_lists__():
-				list.__add_to_db__()
+		self.WriteLists(item_list)
 		
 		if commit:
 			self.connection.commit()
 
+	def BulkAdd(self, items:list, batch=10000, commit=True):
+		"""
+		Adds the items as rows to their corresponding tables.
+		Unlike AddList, items may be of different classes.
+
+		Rows are inserted with one executemany per class for every
+		batch items, all inside a single transaction.
+
+		If commit is False, then the change will not be
+		immediately committed to the DB.
+		"""
+		# group the items by class, keeping their order
+		pending = {}
+		for item in items:
+			pending.setdefault(item.__class__, []).append(item)
+
+		self.Begin()
+		for item_list in pending.values():
+			for i in range(0, len(item_list), batch):
+				self.AddList(item_list[i:i+batch], commit=False)
+
+		if commit:
+			self.connection.commit()
+
+	def Upsert(self, item, force_update=False, commit=True):
+		"""
+		Adds the item as a row to its corresponding table, or
+		updates its row if it already has one, in a single
+		insert ... on conflict statement.
+
+		If commit is False, then the change will not be
+		immediately committed to the DB.
+		"""
+		data_class = item.__class__
+		dc_name = data_class.__name__
+
+		if item.__dict__.get("dbid", -1) == -1:
+			self.Add(item, commit=commit)
+			return
+
+		if data_class.__immutable__ and not force_update:
+			print(f"WARNING: Can't update immutable type {dc_name}!")
+			return
+		self.Begin()
+		self.column_cache.pop(dc_name, None)
+
+		self.connection.execute(
+			data_class.__sql_upsert__,
+			data_class.__fast_row__(item)
+		)
+		self.cache[dc_name][item.dbid] = item
+
+		# Finally, update lists
+		self.WriteLists( (item,) )
+
+		if commit:
+			self.connection.commit()
+
 	def Update(self, item, force_update=False, commit=True):
 		"""
 		Updates the row of item in its corresponding table.
@@ -437,56 +693,24 @@ class SQL:
 		immediately committed to the DB.
 		"""
 		data_class = item.__class__
-
-		table_name = data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
 		item_dict = item.__dict__
-		valid_columns = item_dict.keys()
-
-		if "dbid" in valid_columns:
-			# construct the sql update command
-			dbid = item.dbid
 
+		if "dbid" in item_dict:
 			# TODO: maybe handle caching here instead of in reference
 			if data_class.__immutable__ and not force_update:
 				print(f"WARNING: Can't update immutable type {data_class.__name__}!")
 				return
-
-			update_list = []
-
-			column_name = lambda c : c[0]
-			column_type = lambda c : c[1]
-			
-			cmd = f"update {table_name} set "
-			
-			def add_to_column_list(column):
-				name = column_name(column)
-				if name in valid_columns:
-					val = item_dict[name]
-					if hasattr(val, "__sql_adapter__"):
-						val = val.__sql_adapter__()
-					update_list.append( val )
-				else:
-					update_list.append(
-						SQL.TYPE_DEFAULT[ column_type(column) ]
-					)
-
-			col_range = len(sql_columns) - 1
-			for i in range(col_range ):
-				column = sql_columns[i]
-				add_to_column_list(column)
-				cmd = cmd + f"{column_name(column)} = ?, "
-			column = sql_columns[col_range]
-			add_to_column_list(column)
-			cmd = cmd + f"{column_name(column)} = ? where dbid = ?"
-			update_list.append( dbid )
+			self.Begin()
+			self.column_cache.pop(data_class.__name__, None)
 
 			# update the db
-			self.connection.execute(cmd, tuple(update_list) )
+			self.connection.execute(
+				data_class.__sql_update__,
+				self._update_tuple(item, data_class)
+			)
 
 			# Finally, update lists
-			for list in item.__get_lists__():
-				list.__update_to_db__()
+			self.WriteLists( (item,) )
 
 			if commit:
 				self.connection.commit()
@@ -505,85 +729,63 @@ class SQL:
 			return
 
 		data_class 	= item_list[0].__class__
-		table_name 	= data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
 
-		if data_class.__immutable__ and not force_update:
-			print(f"WARNING: Can't update immutable type {data_class.__name__}!")
-			return
-
-		arg_list = []
 		i_list = []
 		add_list = []
-		
-		column_name = lambda c : c[0]
-		column_type = lambda c : c[1]
-
-		# Build SQL command from first item
-		cmd = f"update {table_name} set "
-		item = item_list[0]
-		col_range = len(sql_columns) - 1
-		for i in range(col_range ):
-			column = sql_columns[i]
-			cmd = cmd + f"{column_name(column)} = ?, "
-		column = sql_columns[col_range]
-		cmd = cmd + f"{column_name(column)} = ? where dbid = ?"
-
-		# Insert actual values to update
 		for item in item_list:
-			item_dict = item.__dict__
-			valid_columns = item_dict.keys()
-
-			if "dbid" in valid_columns:
-				# construct the sql update command
-				dbid = item.dbid
-
-				update_list = []
-				def add_to_column_list(column):
-					name = column_name(column)
-					if name in valid_columns:
-						val = item_dict[name]
-						if hasattr(val, "__sql_adapter__"):
-							val = val.__sql_adapter__()
-						update_list.append( val )
-					else:
-						update_list.append(
-							SQL.TYPE_DEFAULT[ column_type(column) ]
-						)
-
-				col_range = len(sql_columns) - 1
-				for i in range(col_range ):
-					column = sql_columns[i]
-					add_to_column_list(column)
-				column = sql_columns[col_range]
-				add_to_column_list(column)
-				update_list.append( dbid )
-
-				# Add this to the argument list
-				arg_list.append(tuple(update_list))
-				# Add item to list of possible list containers
+			if item.__dict__.get("dbid", -1) != -1:
 				i_list.append(item)
 			else:
 				add_list.append(item)
 
-			# add to db any items that weren't in it
-			self.AddList(add_list, commit=commit)
+		# new items can still be added to an immutable table
+		if len(i_list) > 0 and data_class.__immutable__ and not force_update:
+			print(f"WARNING: Can't update immutable type {data_class.__name__}!")
+			i_list = []
 
-			# update the db
-			self.connection.executemany(cmd, arg_list)
-		
-			# Finally, update lists
-			for item in i_list:
-				for list in item.__get_lists__():
-					list.__update_to_db__()
+		# Collect the values to update, issuing them
+		# all at once with executemany below
+		arg_list = [ self._update_tuple(item, data_class) for item in i_list ]
 
-			if commit:
-				self.connection.commit()
+		self.Begin()
+		self.column_cache.pop(data_class.__name__, None)
+
+		# add to db any items that weren't in it
+		self.AddList(add_list, commit=False)
+
+		# update the db
+		self.connection.executemany(data_class.__sql_update__, arg_list)
+	
+		# Finally, update lists
+		self.WriteLists(i_list)
+
+		if commit:
+			self.connection.commit()
+
+	def WriteLists(self, item_list):
+		"""
+		Internal method to write the children of every List held by
+		the items in item_list. Children are gathered across all the
+		items and written with one UpdateList per child class.
+		"""
+		# a child can turn up more than once, e.g. in two lists, or
+		# as both a former and a current item, so key them by identity
+		children = {}
+		for item in item_list:
+			for child_list in item.__get_lists__():
+				list_items = child_list.__items_to_db__()
+				if len(list_items) > 0:
+					child_dict = children.setdefault(child_list.child_dc, {})
+					for child in list_items:
+						child_dict[id(child)] = child
 
-	def CopyRowToData(data_class:type, row:sqlite3.Row, existing_item=None):
+		for child_dict in children.values():
+			self.UpdateList(list(child_dict.values()), commit=False)
+
+	def CopyRowToData(data_class:type, row:tuple, existing_item=None):
 		"""
-		Internal method to transform data returned from the DB as sqlite3.Row
-		into a corresponding object.
+		Internal method to transform a row returned from the DB by
+		__sql_select__ into a corresponding object.
 
 		If existing_item is None, then the method will allocate a new object.
 		Otherwise, it will copy the data into the attributes of existing_item.
@@ -594,58 +796,80 @@ class SQL:
 			item = existing_item
 
 		annotations = data_class.__annotations__
-		for column_name in row.keys():
-			if column_name == "dbid":
-				item.dbid = row["dbid"]
-			else:
-				# set the value
-				if column_name in annotations:
-					# if it's a reference, set the ref_id only
-					ref = item.__get_reference__(column_name)
-					if ref != None:
-						ref.__sql_converter__(row[column_name])
-						continue
-							
-				setattr(
-					item,
-					column_name, 
-					row[column_name]
-				)
+		# Write straight into the instance dict, which skips
+		# DBObject.__setattr__ (only needed for Reference and List)
+		idict = item.__dict__
+		# dbid comes first, then the columns in order
+		idict["dbid"] = row[0]
+		for i, column in enumerate(data_class.__sql_columns__):
+			column_name = column[0]
+			value = row[i+1]
+			# set the value
+			if column_name in annotations:
+				# if it's a reference, set the ref_id only
+				ref = item.__get_reference__(column_name)
+				if ref != None:
+					ref.__sql_converter__(value)
+					continue
+						
+			idict[column_name] = value
+		# Every column is now set, so an immutable item
+		# never needs to be copied into again
+		idict["__loaded__"] = True
 		# Mark lists as preexisting from db
 		item.__mark_lists_from_db__()
 		return item
 
-	def ProcessRow(self, data_class:str, row:sqlite3.Row):
+	def ProcessRow(self, data_class:str, row:tuple, cache=None):
 		"""
 		Process an individual Row returned from the DB. To ensure that
 		there are no duplicate copies of objects in memory, this method 
 		checks the cache to see if memory has already been allocated,
 		or adds a new block of allocated memory to the cache otherwise.
+
+		Callers processing many rows can pass the class's cache
+		to avoid looking it up for every row.
 		"""
-		dbid = row["dbid"]
-		dc_name = data_class.__name__
-		item = None
+		if cache == None:
+			cache = self.cache[data_class.__name__]
+		dbid = row[0]
 		# If the item is in the cache, we copy the result
 		# into the same block of memory. Otherwise, we
 		# make a new item, cache it, then return
-		if dbid in self.cache[dc_name].keys():
-			# in cache
-			item = self.cache[dc_name][dbid]
-			SQL.CopyRowToData(data_class, row, item)
+		item = cache.get(dbid)
+		if item != None:
+			# in cache; immutable rows can't have changed, but items
+			# cached by Add may still be missing unset columns
+			if not data_class.__immutable__ or "__loaded__" not in item.__dict__:
+				SQL.CopyRowToData(data_class, row, item)
 		else:
 			# not in cache already
 			item = SQL.CopyRowToData(data_class, row)
-			self.cache[dc_name][dbid] = item
+			cache[dbid] = item
 		return item
 
-	def ExecuteSelect(cursor, table_name:str, args:tuple, orderby:str):
+	def FetchOne(cursor):
+		"""
+		Internal method to return the first row of an executed query,
+		or None. The query is read to completion, so that its statement
+		is reset and doesn't hold a read transaction open on the
+		shared cursor.
+		"""
+		rows = cursor.fetchall()
+		if len(rows) == 0:
+			return None
+		return rows[0]
+
+	def ExecuteSelect(cursor, data_class:type, args:tuple, orderby:str, limit=0):
 		"""
 		Execute a SELECT command with WHERE query arguments, and 
-		optional ORDER BY.
+		optional ORDER BY and LIMIT.
 		"""
-		cmd = f"select * from {table_name} where {args[0]}"
+		cmd = f"{data_class.__sql_select__} where {args[0]}"
 		if orderby != "":
 			cmd = cmd + f" order by {orderby}"
+		if limit > 0:
+			cmd = cmd + f" limit {limit}"
 		cursor.execute(cmd, args[1])
 		
 	def Select(self, data_class:type, args:tuple, orderby="") -> list:
@@ -657,15 +881,16 @@ class SQL:
 		args 	-- Produced by chaining Query functions.
 		orderby	-- Produced by chaining Query.Order* functions.
 		"""
-		table_name = data_class.__tablename__
-		cursor = self.connection.cursor()
-		SQL.ExecuteSelect(cursor, table_name, args, orderby)
-		results = cursor.fetchall()
+		cursor = self.cursor
+		SQL.ExecuteSelect(cursor, data_class, args, orderby)
+		# read every row first: building an object runs its class's
+		# __init__, which may itself read from the shared cursor
+		rows = cursor.fetchall()
+		cache = self.cache[data_class.__name__]
 		search_list = []
-		for result in results:
-			item = self.ProcessRow(data_class, result)
+		for result in rows:
+			item = self.ProcessRow(data_class, result, cache)
 			search_list.append(item)
-		cursor.close()
 		return search_list
 	
 	def SelectOne(self, data_class:type, args:tuple) -> list:
@@ -676,14 +901,12 @@ class SQL:
 
 		args 	-- Produced by chaining Query functions.
 		"""
-		table_name = data_class.__tablename__
-		cursor = self.connection.cursor()
-		SQL.ExecuteSelect(cursor, table_name, args, "")
-		result = cursor.fetchone()
+		cursor = self.cursor
+		SQL.ExecuteSelect(cursor, data_class, args, "", limit=1)
+		result = SQL.FetchOne(cursor)
 		if result == None:
 			return None
 		item = self.ProcessRow(data_class, result)
-		cursor.close()
 		return item
 	
 	def SelectAtIndex(self, data_class:type, index:int) -> object:
@@ -694,15 +917,19 @@ class SQL:
 
 		index 	-- index of row in table (dbid, or primary key)
 		"""
-		table_name = data_class.__tablename__
-		cursor = self.connection.cursor()
-		cmd = f"select * from {table_name} where dbid = ?"
-		cursor.execute(cmd, (index,) )
-		result = cursor.fetchone()
+		# immutable rows can be served straight from the cache,
+		# once they've been loaded from the DB in full
+		if data_class.__immutable__:
+			item = self.cache[data_class.__name__].get(index)
+			if item != None and "__loaded__" in item.__dict__:
+				return item
+
+		cursor = self.cursor
+		cmd = f"{data_class.__sql_select__} where dbid = ?"
+		result = SQL.FetchOne(cursor.execute(cmd, (index,) ))
 		if result == None:
 			return None
 		item = self.ProcessRow(data_class, result)
-		cursor.close()
 		return item
 	
 	def RandomEntries(self, data_class:type, num=1) -> list:
@@ -713,15 +940,109 @@ class SQL:
 
 		num 	-- number of rows to return
 		"""
-		table_name = data_class.__tablename__
-		cursor = self.connection.cursor()
+		num = max(1, int(num))
+		cursor = self.cursor
+		cache = self.cache[data_class.__name__]
+
+		# For a few rows out of many, look up randomly chosen dbids
+		# rather than sorting the whole table by random()
+		low, high = SQL.FetchOne(cursor.execute(
+			f"select min(dbid), max(dbid) from {data_class.__tablename__}"
+		))
+		if low == None:
+			return []
+		span = high - low + 1
+		if num <= SQL.RANDOM_LOOKUP_MAX and num * 4 <= span:
+			# dbids can have gaps, so draw a few spares
+			dbids = sample( range(low, high + 1), num * 2 )
+			# look them up in chunks to stay under the variable limit
+			rows = {}
+			step = SQL.MAX_VARIABLES
+			for i in range(0, len(dbids), step):
+				chunk = dbids[i:i + step]
+				params = ", ".join( ["?"] * len(chunk) )
+				cursor.execute(
+					f"{data_class.__sql_select__} where dbid in ({params})",
+					chunk
+				)
+				for row in cursor:
+					rows[row[0]] = row
+			# keep the random order of the draw
+			found = [ rows[dbid] for dbid in dbids if dbid in rows ]
+			if len(found) >= num:
+				return [
+					self.ProcessRow(data_class, row, cache)
+					for row in found[:num]
+				]
+
 		cursor.execute(
-			f"select * from {table_name} order by random() limit {max(1, int(num))}"
+			f"{data_class.__sql_select__} order by random() limit {num}"
 		)
-		results = cursor.fetchall()
+		# as in Select, read every row before building objects
+		rows = cursor.fetchall()
 		search_list = []
-		for result in results:
-			item = self.ProcessRow(data_class, result)
+		for result in rows:
+			item = self.ProcessRow(data_class, result, cache)
 			search_list.append(item)
-		cursor.close()
-		return search_list
\ No newline at end of file
+		return search_list
+
+	def LoadColumns(self, data_class:type) -> dict:
+		"""
+		Internal method to read a whole table with a single SELECT,
+		and return it column by column, keyed by column name.
+		"""
+		cursor = self.cursor
+		cursor.execute(f"{data_class.__sql_select__} order by dbid")
+		rows = cursor.fetchall()
+
+		sql_columns = [ ("dbid", "integer") ] + list(data_class.__sql_columns__)
+		if len(rows) > 0:
+			values_list = list( zip(*rows) )
+		else:
+			values_list = [ () ] * len(sql_columns)
+
+		columns = {}
+		for column, values in zip(sql_columns, values_list):
+			typecode = SQL.TYPE_ARRAY.get(column[1])
+			if typecode != None:
+				try:
+					values = array(typecode, values)
+				except TypeError:
+					# NULLs can't be stored in an array
+					values = list(values)
+			else:
+				values = list(values)
+			columns[column[0]] = values
+		return columns
+
+	def Columns(self, data_class:type, *column_names) -> dict:
+		"""
+		Returns whole columns of a table, keyed by column name, along
+		with a "dbid" column giving the dbid of each position. Integer
+		and real columns are stored compactly as array.array, other
+		columns as lists.
+
+		For immutable classes, the columns are loaded with one SELECT
+		and then kept in memory until the table is next written to,
+		which suits bulk reads over large read-only tables. Each call
+		returns its own copies of the cached columns.
+
+		Arguments:
+
+		column_names	-- columns to return; all of them if none are given
+		"""
+		dc_name = data_class.__name__
+		columns = self.column_cache.get(dc_name)
+		if columns == None:
+			columns = self.LoadColumns(data_class)
+			if data_class.__immutable__:
+				self.column_cache[dc_name] = columns
+
+		if len(column_names) == 0:
+			column_names = tuple(columns)
+		else:
+			column_names = ("dbid",) + column_names
+		if data_class.__immutable__:
+			# hand out copies, so callers can't change the cached columns
+			return { name : columns[name][:] for name in column_names }
+		return { name : columns[name] for name in column_names }
\ No newline at end of file
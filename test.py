@@ -1,3 +1,4 @@
+from datetime import date
 from random import choice
 
 from narwhal.sql import SQL, Query
@@ -93,4 +94,131 @@ if __name__ == '__main__':
 		# Bellona (the name of the vessel on which the 121st crew member serves)
 		print(List[Crew].ReverseLookup(v.crew[120], Vessel, "crew").name)
 		# size of data stored in memory from the db
-		print(f"Size of DB data stored in memory: {sql.CacheSize()} bytes")
\ No newline at end of file
+		print(f"Size of DB data stored in memory: {sql.CacheSize()} bytes")
+
+	# BulkAdd takes items of mixed classes, and writes each
+	# class with batched inserts inside a single transaction
+	n_crew = sql.TableLength(Crew)
+	n_history = sql.TableLength(HistoryString)
+	mixed = []
+	for i in range(250):
+		c = Crew()
+		c.name = f"bulk_{i}"
+		mixed.append(c)
+		h = HistoryString()
+		h.line_txt = f"joined as bulk_{i}"
+		h.date = date(1805, 10, 21)
+		mixed.append(h)
+	# list children are written along with their parent
+	h = HistoryString()
+	h.line_txt = "rated able seaman"
+	h.date = date(1806, 1, 9)
+	c.history.append(h)
+	sql.BulkAdd(mixed, batch=100)
+	assert sql.TableLength(Crew) == n_crew + 250
+	assert sql.TableLength(HistoryString) == n_history + 251
+	assert len({ item.dbid for item in mixed[0::2] }) == 250
+	assert len({ item.dbid for item in mixed[1::2] }) == 250
+	assert -1 not in { item.dbid for item in mixed }
+	assert len( sql.Select(Crew, Query.Like("name", "bulk_%")) ) == 250
+
+	# Serialize upserts: an existing row is updated in place...
+	c = Crew()
+	c.name = "upsert"
+	c.Serialize()
+	dbid = c.dbid
+	n_crew = sql.TableLength(Crew)
+	c.courage = 7
+	c.Serialize()
+	assert c.dbid == dbid
+	assert sql.TableLength(Crew) == n_crew
+	assert sql.SelectOne(Crew, Query.Equals("courage", 7)).dbid == dbid
+	# ...and a row that has been cleared is written back under its dbid
+	sql.Clear(Crew)
+	c.courage = 8
+	c.Serialize()
+	assert c.dbid == dbid
+	assert sql.TableLength(Crew) == 1
+	c = sql.SelectOne(Crew, Query.Equals("dbid", dbid))
+	assert c.name == "upsert" and c.courage == 8
+
+	# Columns of immutable classes are cached until the table is written to
+	columns = sql.Columns(VesselClass, "name", "masts")
+	assert columns["masts"].typecode == "q"
+	assert "VesselClass" in sql.column_cache
+	n_classes = len(columns["dbid"])
+	vc = VesselClass()
+	vc.name = "Surprise-class"
+	vc.masts = 3
+	sql.Add(vc)
+	assert "VesselClass" not in sql.column_cache
+	columns = sql.Columns(VesselClass, "name", "masts")
+	assert len(columns["dbid"]) == n_classes + 1
+	assert columns["name"][-1] == "Surprise-class"
+	assert columns["masts"][-1] == 3
+	# the cached columns can't be changed through a returned copy
+	columns["masts"][-1] = 99
+	assert sql.Columns(VesselClass, "masts")["masts"][-1] == 3
+
+	# RandomEntries copes with sparse dbids, whether it picks rows
+	# by dbid lookup or falls back to sorting by random()
+	sql.Clear(Crew)
+	for i in range(200):
+		c = Crew()
+		c.name = f"sparse_{i}"
+		# skip every fourth dbid
+		c.dbid = i + i // 3
+		sql.Upsert(c, commit=False)
+	sql.Commit()
+	for num in (20, 150, 500):
+		picked = sql.RandomEntries(Crew, num)
+		assert len(picked) == min(num, 200)
+		assert len({ c.dbid for c in picked }) == len(picked)
+		assert all( c.dbid % 4 != 3 for c in picked )
+
+	# Building an object runs its class's __init__, which may run reads
+	# of its own while Select and RandomEntries are returning rows
+	def reading_init(self):
+		super(Crew, self).__init__()
+		sql.TableLength(HistoryString)
+	Crew.__init__ = reading_init
+	sql.cache["Crew"].clear()
+	assert len( sql.Select(Crew, Query.Like("name", "sparse_%")) ) == 200
+	sql.cache["Crew"].clear()
+	assert len( sql.RandomEntries(Crew, 150) ) == 150
+	del Crew.__init__
+
+	# Tables created by older versions of narwhal have no autoincrement,
+	# so the DB may have no sqlite_sequence table at all
+	legacy = SQL(":memory:")
+	legacy.RegisterTables([
+		Crew,
+		VesselClass,
+		Vessel,
+		HistoryString
+	])
+	for (cmd,) in sql.connection.execute(
+		"select sql from sqlite_master where type = 'table' "
+		"and name != 'sqlite_sequence'"
+	):
+		legacy.connection.execute( cmd.replace(" autoincrement", "") )
+	clist = []
+	for i in range(10):
+		c = Crew()
+		c.name = f"legacy_{i}"
+		clist.append(c)
+	legacy.AddList(clist)
+	# whichever method adds them, dbids start at 1
+	assert [ c.dbid for c in clist ] == list( range(1, 11) )
+	c = Crew()
+	c.name = "legacy_parent"
+	h = HistoryString()
+	h.line_txt = "signed on"
+	h.date = date(1805, 3, 2)
+	c.history.append(h)
+	c.Serialize()
+	assert c.dbid == 11 and h.dbid == 1
+	assert legacy.TableLength(HistoryString) == 1
+	assert SQL.FetchOne( legacy.cursor.execute(
+		"select count(*) from sqlite_master where name = 'sqlite_sequence'"
+	) )[0] == 0